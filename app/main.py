@@ -1,5 +1,10 @@
 import os
+import hmac
+import time
+import hashlib
+import secrets
 import datetime
+from functools import lru_cache
 from typing import Optional, List
 
 from fastapi import FastAPI, Request, Depends, Form, HTTPException, status
@@ -7,7 +12,12 @@ from fastapi.responses import HTMLResponse, RedirectResponse
 from fastapi.templating import Jinja2Templates
 from fastapi.staticfiles import StaticFiles
 from sqlmodel import SQLModel, Field, Session, create_engine, select
-from apscheduler.schedulers.background import BackgroundScheduler
+from sqlmodel.ext.asyncio.session import AsyncSession
+from sqlalchemy import event
+from sqlalchemy.pool import QueuePool
+from sqlalchemy.ext.asyncio import create_async_engine
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from apscheduler.executors.pool import ProcessPoolExecutor
 from apscheduler.triggers.cron import CronTrigger
 import uvicorn
 
@@ -27,6 +37,16 @@ class Settings(SQLModel, table=True):
     admin_user: str = "admin"
     admin_password: str = "admin"
 
+    @property
+    def smtp_conf(self) -> dict:
+        """BackupManager 需要的 SMTP 配置字典"""
+        return {
+            "server": self.smtp_server,
+            "port": self.smtp_port,
+            "user": self.smtp_user,
+            "password": self.smtp_password
+        }
+
 class BackupTask(SQLModel, table=True):
     id: Optional[int] = Field(default=None, primary_key=True)
     name: str
@@ -41,7 +61,11 @@ class BackupTask(SQLModel, table=True):
 # --- 初始化 ---
 
 app = FastAPI()
+# auto_reload=False: 模板编译一次后常驻缓存，渲染时不再 stat 模板文件
+# (容器内模板不会热更，开发时 uvicorn --reload 重启进程即可)。
+# 直接设在 environment 上：构造参数透传在新版 starlette 已被移除
 templates = Jinja2Templates(directory="app/templates")
+templates.env.auto_reload = False
 
 # 数据库初始化 (持久化存储在 /data 目录)
 sqlite_file_name = "/data/database.db"
@@ -50,70 +74,167 @@ if not os.path.exists("/data"):
 sqlite_url = f"sqlite:///{sqlite_file_name}"
 
 # check_same_thread=False 是 SQLite 在多线程(FastAPI)环境下的必要参数
-engine = create_engine(sqlite_url, connect_args={"check_same_thread": False})
+# QueuePool 让各线程复用已打开的连接，避免每个请求重新 open 数据库文件
+# 同步引擎：供调度器工作进程使用 (进程池里跑的是同步代码)
+engine = create_engine(
+    sqlite_url,
+    connect_args={"check_same_thread": False},
+    poolclass=QueuePool,
+    pool_size=5,
+    max_overflow=10,
+)
+
+# 异步引擎：供 Web 路由使用，事件循环不再被 SQLite IO 阻塞
+async_engine = create_async_engine(
+    f"sqlite+aiosqlite:///{sqlite_file_name}",
+    connect_args={"check_same_thread": False},
+    pool_size=5,
+    max_overflow=10,
+)
+
+def _set_sqlite_pragmas(dbapi_conn, _record):
+    """每个新连接启用 WAL 模式：读写不再互相阻塞，fsync 次数也更少"""
+    cursor = dbapi_conn.cursor()
+    cursor.execute("PRAGMA journal_mode=WAL")
+    cursor.execute("PRAGMA synchronous=NORMAL")
+    cursor.execute("PRAGMA busy_timeout=5000")
+    cursor.close()
+
+event.listen(engine, "connect", _set_sqlite_pragmas)
+event.listen(async_engine.sync_engine, "connect", _set_sqlite_pragmas)
 
 # 创建表结构
 SQLModel.metadata.create_all(engine)
 
 # 调度器初始化
-scheduler = BackgroundScheduler()
-scheduler.start()
+# 备份任务放到独立的进程池执行：压缩/发信是 CPU 和 IO 重活，
+# 放在默认线程池里会和 Web 请求抢 GIL 和线程
+# AsyncIOScheduler 挂在 uvicorn 的事件循环上，在 startup 事件中启动
+scheduler = AsyncIOScheduler(
+    executors={
+        "default": {"type": "threadpool", "max_workers": 10},
+        "backup": ProcessPoolExecutor(max_workers=2),
+    },
+    job_defaults={
+        # 进程忙/停机期间积压的多次触发只补跑一次
+        "coalesce": True,
+        # 同一个备份任务绝不并发执行
+        "max_instances": 1,
+        # 错过触发点 1 小时内仍然补跑，超过则丢弃
+        "misfire_grace_time": 3600,
+    },
+)
 
 # --- 辅助函数 ---
 
-def get_session():
-    with Session(engine) as session:
+async def get_session():
+    async with AsyncSession(async_engine) as session:
         yield session
 
+# Cookie 签名密钥: 优先取环境变量 (多实例/重启后会话不失效)，
+# 否则每次启动随机生成，重启后需要重新登录
+AUTH_SECRET = (os.getenv("PANEL_SECRET") or secrets.token_hex(32)).encode()
+AUTH_MAX_AGE = 86400
+
+def _sign_expiry(expires: str) -> str:
+    return hmac.new(AUTH_SECRET, expires.encode(), hashlib.sha256).hexdigest()
+
+def make_auth_token() -> str:
+    """生成带过期时间的签名 token: '<expires>.<hmac>'"""
+    expires = str(int(time.time()) + AUTH_MAX_AGE)
+    return f"{expires}.{_sign_expiry(expires)}"
+
 def verify_auth(request: Request):
-    """简单的 Cookie 验证"""
+    """校验 Cookie 中的签名 token (常数时间比较，防时序侧信道)"""
     token = request.cookies.get("auth_token")
-    if not token:
+    if not token or "." not in token:
         return False
-    return True
+    expires, sig = token.rsplit(".", 1)
+    # isdigit() 会放过非 ASCII 数字码位 (如 "²")，必须兜住 int() 的异常
+    try:
+        if int(expires) < time.time():
+            return False
+    except ValueError:
+        return False
+    return hmac.compare_digest(sig, _sign_expiry(expires))
+
+# Settings 只有一行且几乎不变，缓存起来避免每个请求都查库
+_settings_cache: Optional[Settings] = None
+
+def invalidate_settings_cache():
+    global _settings_cache
+    _settings_cache = None
+
+def _sync_env_overrides(s: Settings, is_new: bool) -> bool:
+    """把环境变量 PANEL_USER / PANEL_PASSWORD 同步到 Settings 对象。
+    环境变量 (来自 docker-compose.yml) 优先于数据库记录。
+    返回是否有变更需要写回数据库。
+    """
+    env_user = os.getenv("PANEL_USER")
+    env_pass = os.getenv("PANEL_PASSWORD")
+    changed = False
+    if env_user and s.admin_user != env_user:
+        s.admin_user = env_user
+        changed = True
+    if env_pass and s.admin_password != env_pass:
+        s.admin_password = env_pass
+        changed = True
+    if changed and not is_new:
+        print(f"System: 检测到环境变量变更，已更新面板账号/密码。")
+    return changed
 
 def get_settings(session: Session):
     """
-    获取设置。
+    获取设置 (同步版本，供调度器工作进程使用)。
     逻辑：
-    1. 获取数据库记录。
-    2. 检查环境变量 PANEL_USER 和 PANEL_PASSWORD。
-    3. 如果环境变量存在且与数据库不一致，优先使用环境变量并更新数据库。
+    1. 命中内存缓存则直接返回 (保存设置时会失效缓存)。
+    2. 获取数据库记录 (不存在则初始化默认配置)。
+    3. 环境变量存在且与数据库不一致时，优先环境变量并更新数据库。
     """
-    s = session.exec(select(Settings)).first()
-    
-    # 环境变量 (来自 docker-compose.yml)
-    env_user = os.getenv("PANEL_USER")
-    env_pass = os.getenv("PANEL_PASSWORD")
+    global _settings_cache
+    if _settings_cache is not None:
+        return _settings_cache
 
-    if not s:
-        # 初始化默认配置
+    s = session.exec(select(Settings)).first()
+    is_new = s is None
+    if is_new:
         s = Settings()
-        if env_user: s.admin_user = env_user
-        if env_pass: s.admin_password = env_pass
+    if _sync_env_overrides(s, is_new) or is_new:
         session.add(s)
         session.commit()
         session.refresh(s)
-    else:
-        # 同步环境变量到数据库
-        changed = False
-        if env_user and s.admin_user != env_user:
-            s.admin_user = env_user
-            changed = True
-        if env_pass and s.admin_password != env_pass:
-            s.admin_password = env_pass
-            changed = True
-        
-        if changed:
-            print(f"System: 检测到环境变量变更，已更新面板账号/密码。")
-            session.add(s)
-            session.commit()
-            session.refresh(s)
-            
+
+    # 从 session 摘除后缓存，后续读取不再依赖任何 session
+    session.expunge(s)
+    _settings_cache = s
+    return s
+
+async def get_settings_async(session: AsyncSession):
+    """获取设置 (异步版本，供 Web 路由使用)，逻辑同 get_settings"""
+    global _settings_cache
+    if _settings_cache is not None:
+        return _settings_cache
+
+    s = (await session.exec(select(Settings))).first()
+    is_new = s is None
+    if is_new:
+        s = Settings()
+    if _sync_env_overrides(s, is_new) or is_new:
+        session.add(s)
+        await session.commit()
+        await session.refresh(s)
+
+    session.expunge(s)
+    _settings_cache = s
     return s
 
 def run_backup_job(task_id: int):
-    """调度器调用的实际执行函数"""
+    """调度器调用的实际执行函数 (在独立的工作进程中运行)"""
+    # 工作进程是从主进程 fork 出来的：
+    # 1. 丢弃继承自父进程的连接池，避免跨进程共用 SQLite 连接
+    # 2. 失效继承的 Settings 缓存，确保拿到面板上最新保存的配置
+    engine.dispose(close=False)
+    invalidate_settings_cache()
     # 每次执行任务时重新创建 Session
     with Session(engine) as session:
         task = session.get(BackupTask, task_id)
@@ -130,18 +251,13 @@ def run_backup_job(task_id: int):
         session.commit()
         session.refresh(task)
 
-        # 准备配置
-        smtp_conf = {
-            "server": settings.smtp_server,
-            "port": settings.smtp_port,
-            "user": settings.smtp_user,
-            "password": settings.smtp_password
-        }
-        task_conf = task.dict()
-        
+        # 准备配置 (压缩密码不进 task_conf 字典，单独传递)
+        task_conf = task.model_dump(exclude={"zip_password"})
+
         # 执行备份逻辑
         try:
-            manager = BackupManager(smtp_conf, task_conf)
+            manager = BackupManager(settings.smtp_conf, task_conf,
+                                    zip_password=task.zip_password)
             success = manager.run()
             task.status = "成功" if success else "失败"
         except Exception as e:
@@ -153,37 +269,62 @@ def run_backup_job(task_id: int):
         session.add(task)
         session.commit()
 
+@lru_cache(maxsize=128)
+def get_cron_trigger(cron: str) -> CronTrigger:
+    """解析 cron 表达式并缓存结果。
+    CronTrigger 无状态、可在多个 job 间共享，同一表达式只解析一次。
+    """
+    return CronTrigger.from_crontab(cron)
+
+def schedule_task(task: BackupTask):
+    """注册或更新单个任务的调度 (job_id = task.id，replace_existing 覆盖旧触发器)"""
+    try:
+        scheduler.add_job(
+            run_backup_job,
+            get_cron_trigger(task.cron),
+            args=[task.id],
+            id=str(task.id),
+            executor="backup",
+            replace_existing=True
+        )
+    except Exception as e:
+        print(f"Cron Error for task {task.name}: {e}")
+
+def unschedule_task(task_id: int):
+    """移除单个任务的调度"""
+    try:
+        scheduler.remove_job(str(task_id))
+    except Exception:
+        # 任务可能因 cron 表达式非法而从未注册过
+        pass
+
 def refresh_scheduler():
-    """根据数据库重置所有定时任务"""
+    """根据数据库重置所有定时任务 (仅启动时使用，增删改走增量接口)"""
     scheduler.remove_all_jobs()
     with Session(engine) as session:
         tasks = session.exec(select(BackupTask)).all()
         print(f"Scheduler: 正在重新加载 {len(tasks)} 个定时任务...")
         for task in tasks:
-            try:
-                # 使用 task.id 作为 job_id，防止重复
-                scheduler.add_job(
-                    run_backup_job, 
-                    CronTrigger.from_crontab(task.cron), 
-                    args=[task.id], 
-                    id=str(task.id),
-                    replace_existing=True
-                )
-            except Exception as e:
-                print(f"Cron Error for task {task.name}: {e}")
-
-# 应用启动时加载任务
-refresh_scheduler()
+            schedule_task(task)
+
+@app.on_event("startup")
+async def on_startup():
+    # AsyncIOScheduler 需要运行中的事件循环，必须在这里启动
+    scheduler.start()
+    # 应用启动时加载任务
+    refresh_scheduler()
 
 # --- 路由定义 ---
 
 @app.get("/", response_class=HTMLResponse)
-async def dashboard(request: Request, session: Session = Depends(get_session)):
+async def dashboard(request: Request, session: AsyncSession = Depends(get_session)):
     if not verify_auth(request):
         return RedirectResponse("/login", status_code=302)
-    
-    tasks = session.exec(select(BackupTask)).all()
-    settings = get_settings(session)
+
+    # 一次查询取回所有任务 (状态/最后运行时间就在行内，无需额外查询)，
+    # 按 id 排序保证列表顺序稳定；settings 走内存缓存
+    tasks = (await session.exec(select(BackupTask).order_by(BackupTask.id))).all()
+    settings = await get_settings_async(session)
     return templates.TemplateResponse("dashboard.html", {
         "request": request, 
         "tasks": tasks, 
@@ -197,15 +338,16 @@ async def login_page(request: Request):
 @app.post("/login")
 async def login_action(
     username: str = Form(...),
-    password: str = Form(...), 
-    session: Session = Depends(get_session)
+    password: str = Form(...),
+    session: AsyncSession = Depends(get_session)
 ):
-    settings = get_settings(session)
+    settings = await get_settings_async(session)
     # 验证账号和密码
     if username == settings.admin_user and password == settings.admin_password:
         response = RedirectResponse("/", status_code=302)
-        # 设置简单的 Cookie 标记
-        response.set_cookie(key="auth_token", value="logged_in", httponly=True, max_age=86400)
+        # 设置签名的登录态 Cookie
+        response.set_cookie(key="auth_token", value=make_auth_token(),
+                            httponly=True, max_age=AUTH_MAX_AGE)
         return response
     
     # 登录失败，带参数跳转
@@ -225,9 +367,12 @@ async def save_settings(
     smtp_password: str = Form(...),
     admin_user: str = Form(...),
     admin_password: str = Form(...),
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_session)
 ):
-    s = get_settings(session)
+    # 直接改数据库行 (缓存中的对象已脱离 session，不能用来写)
+    s = (await session.exec(select(Settings))).first()
+    if not s:
+        s = Settings()
     s.smtp_server = smtp_server
     s.smtp_port = smtp_port
     s.smtp_user = smtp_user
@@ -235,7 +380,9 @@ async def save_settings(
     s.admin_user = admin_user
     s.admin_password = admin_password
     session.add(s)
-    session.commit()
+    await session.commit()
+    # 配置已变更，失效缓存，下次读取时重新加载
+    invalidate_settings_cache()
     return RedirectResponse("/", status_code=302)
 
 @app.post("/task/add")
@@ -246,35 +393,36 @@ async def add_task(
     subject: str = Form(...), 
     to_email: str = Form(""), 
     zip_password: str = Form(""),
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_session)
 ):
     task = BackupTask(
-        name=name, 
-        path=path, 
-        cron=cron, 
-        subject=subject, 
-        to_email=to_email, 
+        name=name,
+        path=path,
+        cron=cron,
+        subject=subject,
+        to_email=to_email,
         zip_password=zip_password
     )
     session.add(task)
-    session.commit()
-    # 添加任务后刷新调度器
-    refresh_scheduler()
+    await session.commit()
+    await session.refresh(task)
+    # 只注册新任务，不动其他已调度的任务
+    schedule_task(task)
     return RedirectResponse("/", status_code=302)
 
 @app.get("/task/delete/{task_id}")
-async def delete_task(task_id: int, session: Session = Depends(get_session)):
-    task = session.get(BackupTask, task_id)
+async def delete_task(task_id: int, session: AsyncSession = Depends(get_session)):
+    task = await session.get(BackupTask, task_id)
     if task:
-        session.delete(task)
-        session.commit()
-        refresh_scheduler()
+        await session.delete(task)
+        await session.commit()
+        unschedule_task(task_id)
     return RedirectResponse("/", status_code=302)
 
 @app.get("/task/run/{task_id}")
-async def run_now(task_id: int, session: Session = Depends(get_session)):
+async def run_now(task_id: int):
     # 立即异步运行一次任务
-    scheduler.add_job(run_backup_job, args=[task_id])
+    scheduler.add_job(run_backup_job, args=[task_id], executor="backup")
     return RedirectResponse("/", status_code=302)
 
 @app.post("/task/edit/{task_id}")
@@ -286,9 +434,9 @@ async def edit_task(
     subject: str = Form(...), 
     to_email: str = Form(""), 
     zip_password: str = Form(""),
-    session: Session = Depends(get_session)
+    session: AsyncSession = Depends(get_session)
 ):
-    task = session.get(BackupTask, task_id)
+    task = await session.get(BackupTask, task_id)
     if task:
         task.name = name
         task.path = path
@@ -296,11 +444,12 @@ async def edit_task(
         task.subject = subject
         task.to_email = to_email
         task.zip_password = zip_password
-        
+
         session.add(task)
-        session.commit()
-        
-        # 修改后必须刷新调度器，否则定时任务还是旧的
-        refresh_scheduler()
-        
+        await session.commit()
+        await session.refresh(task)
+
+        # 修改后只更新本任务的触发器，其他任务的调度保持不动
+        schedule_task(task)
+
     return RedirectResponse("/", status_code=302)